@@ -8,11 +8,13 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from torch_geometric.nn import SAGEConv
+from torch_geometric.typing import SparseTensor, WITH_TORCH_SPARSE
 import numpy as np
+import scipy.sparse as sp
+from scipy.spatial import cKDTree
 import networkx as nx
-from sklearn.preprocessing import StandardScaler
 import pandas as pd
-import matplotlib.pyplot as plt
+import argparse
 import os
 
 class GraphSAGE(nn.Module):
@@ -22,169 +24,249 @@ class GraphSAGE(nn.Module):
         self.conv1 = SAGEConv(in_channels, hidden_channels)
         self.conv2 = SAGEConv(hidden_channels, out_channels)
         
-    def forward(self, x, edge_index):
-        x = self.conv1(x, edge_index)
+    def forward(self, x, adj_t):
+        # adj_t: int64 edge_index or a transposed SparseTensor (CSR)
+        x = self.conv1(x, adj_t)
         x = F.relu(x)
         x = F.dropout(x, p=0.2, training=self.training)
-        x = self.conv2(x, edge_index)
+        x = self.conv2(x, adj_t)
         return x
 
-def generate_uav_network(num_nodes=30, area_size=1000):
+class DenseGraphSAGE(nn.Module):
+    """GraphSAGE on a dense mean-aggregation matrix, for small networks."""
+    def __init__(self, in_channels, hidden_channels, out_channels):
+        super(DenseGraphSAGE, self).__init__()
+        # Same parameterization as SAGEConv: lin_l on neighbors, lin_r on self
+        self.lin_l1 = nn.Linear(in_channels, hidden_channels)
+        self.lin_r1 = nn.Linear(in_channels, hidden_channels, bias=False)
+        self.lin_l2 = nn.Linear(hidden_channels, out_channels)
+        self.lin_r2 = nn.Linear(hidden_channels, out_channels, bias=False)
+        
+    def forward(self, x, adj_mean):
+        x = self.lin_l1(adj_mean @ x) + self.lin_r1(x)
+        x = F.relu(x)
+        x = F.dropout(x, p=0.2, training=self.training)
+        x = self.lin_l2(adj_mean @ x) + self.lin_r2(x)
+        return x
+
+def generate_uav_network(num_nodes=30, area_size=1000, rng=None):
     """Generate drone network diagram"""
     print(f"Generate {num_nodes} nodes UAV network...")
     
+    if rng is None:
+        rng = np.random.default_rng()
+    
     # 1. Generate random positions (3D space)
-    positions = np.random.rand(num_nodes, 3) * [area_size, area_size, 150]
+    positions = rng.random((num_nodes, 3)) * np.array([area_size, area_size, 150])
     
-    # 2. Constructing adjacency matrix based on distance
-    adjacency = np.zeros((num_nodes, num_nodes))
+    # 2. Constructing sparse (CSR) adjacency matrix based on distance; the
+    # KD-tree finds neighbor pairs in O(E log N) without an N x N matrix
     communication_range = 250  # Communication range: 250 meters
     
-    for i in range(num_nodes):
-        for j in range(i+1, num_nodes):
-            dist = np.linalg.norm(positions[i] - positions[j])
-            if dist < communication_range:
-                adjacency[i][j] = 1
-                adjacency[j][i] = 1
+    pairs = cKDTree(positions).query_pairs(communication_range,
+                                           output_type='ndarray')
+    rows = np.concatenate([pairs[:, 0], pairs[:, 1]])
+    cols = np.concatenate([pairs[:, 1], pairs[:, 0]])
+    adjacency = sp.csr_array(
+        (np.ones(rows.size, dtype=np.float32), (rows, cols)),
+        shape=(num_nodes, num_nodes)
+    )
     
     # 3. Construct node features [ETX, remaining energy, queue length]
-    features = np.zeros((num_nodes, 3))
-    for i in range(num_nodes):
-        features[i, 0] = np.random.uniform(0.5, 2.0)  # ETX: 0.5-2.0
-        features[i, 1] = np.random.uniform(0.3, 1.0)  # remaining energy: 30%-100%
-        features[i, 2] = np.random.uniform(0.0, 0.8)  # queue length: 0%-80%
-    
-    # 4. Convert to NetworkX diagram for visualization
-    G = nx.Graph()
-    for i in range(num_nodes):
-        G.add_node(i, pos=positions[i], features=features[i])
-    
-    for i in range(num_nodes):
-        for j in range(i+1, num_nodes):
-            if adjacency[i][j] == 1:
-                G.add_edge(i, j, weight=1.0)
-    
-    print(f"  Average degree: {np.mean(np.sum(adjacency, axis=1)):.2f}")
+    # ETX: 0.5-2.0, remaining energy: 30%-100%, queue length: 0%-80%
+    features = rng.uniform(low=[0.5, 0.3, 0.0], high=[2.0, 1.0, 0.8],
+                           size=(num_nodes, 3))
+    
+    # 4. Convert to NetworkX diagram for visualization (edges only; node
+    # positions and features stay in the arrays above)
+    G = nx.from_scipy_sparse_array(adjacency)
+    
+    print(f"  Average degree: {np.mean(adjacency.sum(axis=1)):.2f}")
     print(f"  Connect components: {nx.number_connected_components(G)}")
     
     return positions, adjacency, features, G
 
-def train_embeddings(num_nodes=30, num_epochs=50):
+def train_embeddings(num_nodes=30, num_epochs=50, rng=None, plot=False):
     """Training GraphSAGE embeddings"""
     print("\n=== Start GraphSAGE training ===")
     
+    if rng is None:
+        rng = np.random.default_rng()
+    
     # parameter
     input_dim = 3      # ETX, E_r, q
     hidden_dim = 32
     output_dim = 16    # 16 Dim
     learning_rate = 0.01
+    num_neg = 50       # Shared negative pool size per epoch
+    
+    # Allow TF32 tensor-core matmuls for the remaining FP32 work
+    torch.set_float32_matmul_precision('high')
+    torch.backends.cuda.matmul.allow_tf32 = True
     
     # Generate training data
-    positions, adjacency, features, G = generate_uav_network(num_nodes)
+    positions, adjacency, features, G = generate_uav_network(num_nodes, rng=rng)
     
     # Convert to PyTorch Geometric format
-    edge_index = []
-    for i in range(num_nodes):
-        for j in range(num_nodes):
-            if adjacency[i][j] == 1:
-                edge_index.append([i, j])
+    rows, cols = adjacency.nonzero()
     
-    if len(edge_index) == 0:
+    if rows.size == 0:
         print("Error: The image has no edges!")
         return None
     
-    edge_index = torch.tensor(edge_index, dtype=torch.long).t()
-    features = torch.tensor(features, dtype=torch.float)
-    
-    # standardized feature
-    scaler = StandardScaler()
-    features_np = features.numpy()
-    features_np = scaler.fit_transform(features_np)
-    features = torch.tensor(features_np, dtype=torch.float)
+    # int32 indices halve the bandwidth of the per-epoch edge gathers
+    edge_index = torch.as_tensor(np.vstack([rows, cols]), dtype=torch.int32)
     
-    # initialization model
     device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
     print(f"Device: {device}")
     
-    model = GraphSAGE(input_dim, hidden_dim, output_dim).to(device)
-    optimizer = torch.optim.Adam(model.parameters(), lr=learning_rate)
+    # standardized feature (population std, as StandardScaler)
+    features = torch.as_tensor(features, dtype=torch.float, device=device)
+    features = (features - features.mean(0)) \
+               / features.std(0, correction=0).clamp_min(1e-8)
     
     # Move data to the device
-    features = features.to(device)
     edge_index = edge_index.to(device)
     
-    # Training cycle
-    losses = []
+    # Positive sample: The actual connected node pair (static across epochs)
+    pos_src = edge_index[0].contiguous()
+    pos_dst = edge_index[1].contiguous()
+    num_pos = pos_src.numel()
+    
+    # Target index buffer: positive destinations followed by the negative
+    # pool, which is refilled in place every epoch
+    target_idx = torch.empty(num_pos + num_neg, dtype=torch.int32, device=device)
+    target_idx[:num_pos] = pos_dst
+    neg_pool = target_idx[num_pos:]
+    
+    # initialization model
+    if num_nodes <= 1000:
+        # Small networks: mean aggregation as one dense GEMM per layer
+        # instead of SAGEConv's scatter/gather kernels
+        adj = torch.as_tensor(adjacency.toarray(), device=device)
+        graph = adj / adj.sum(1, keepdim=True).clamp_min(1)
+        model = DenseGraphSAGE(input_dim, hidden_dim, output_dim).to(device)
+    else:
+        # SAGEConv's scatter_add_ aggregation rejects int32, so the model
+        # gets int64 indices; with torch_sparse, a CSR SparseTensor enables
+        # fused gather-aggregate (symmetric, so it is its own transpose)
+        graph = edge_index.long()
+        if WITH_TORCH_SPARSE:
+            graph = SparseTensor.from_edge_index(
+                graph, sparse_sizes=(num_nodes, num_nodes)
+            )
+        model = GraphSAGE(input_dim, hidden_dim, output_dim).to(device)
+    if device.type == 'cuda':
+        # Capture the forward as CUDA graphs; input shapes never change
+        model = torch.compile(model, mode='reduce-overhead', fullgraph=False)
+    optimizer = torch.optim.Adam(model.parameters(), lr=learning_rate)
+    
+    # On-device generator for negative sampling, seeded from the host rng
+    g_dev = torch.Generator(device=device)
+    g_dev.manual_seed(int(rng.integers(2**63)))
+    
+    # BCE targets for [positive scores, flattened pool scores]; the weights
+    # average each half on its own so negatives do not swamp the positives
+    num_neg_scores = num_pos * num_neg
+    labels = torch.cat([torch.ones(num_pos, device=device),
+                        torch.zeros(num_neg_scores, device=device)])
+    loss_weights = torch.cat([
+        torch.full((num_pos,), 1.0 / num_pos, device=device),
+        torch.full((num_neg_scores,), 1.0 / num_neg_scores, device=device),
+    ])
+    
+    # Training cycle (losses stay on the device until training ends)
+    losses_t = torch.empty(num_epochs, device=device)
+    
+    # Progress log: every 10 epochs the loss is copied to the host without
+    # blocking and printed at the next log step, once that copy has landed
+    pending = []   # (epoch, host loss, copy-done event or None)
+    
     model.train()
     
     for epoch in range(num_epochs):
         optimizer.zero_grad()
         
-        # forward 
-        embeddings = model(features, edge_index)
-        
-        # Use negative sampling loss (simplified)
-        # Positive sample: The actual connected node pair
-        # Negative sample: Randomly sampled node pairs
-        
-        pos_samples = edge_index.t() 
-        num_pos = pos_samples.size(0)
-        
-        # Generate negative samples 
-        # (randomly disconnected node pairs)
-        neg_samples = []
-        while len(neg_samples) < num_pos:
-            i = np.random.randint(0, num_nodes)
-            j = np.random.randint(0, num_nodes)
-            if i != j and adjacency[i][j] == 0:
-                neg_samples.append([i, j])
-        
-        neg_samples = torch.tensor(neg_samples, dtype=torch.long).to(device)
-        
-        # Calculate the similarity of positive samples
-        pos_similarity = torch.sum(
-            embeddings[pos_samples[:, 0]] * embeddings[pos_samples[:, 1]], 
-            dim=1
-        )
-        
-        # Calculate negative sample similarity
-        neg_similarity = torch.sum(
-            embeddings[neg_samples[:, 0]] * embeddings[neg_samples[:, 1]], 
-            dim=1
-        )
-        
-        # Loss function: Maximize positive sample similarity 
-        # and minimize negative sample similarity
-        loss = -torch.log(torch.sigmoid(pos_similarity)).mean() \
-               - torch.log(1 - torch.sigmoid(neg_similarity)).mean()
+        # BF16 autocast on CUDA (no GradScaler needed, unlike FP16)
+        with torch.autocast('cuda', dtype=torch.bfloat16,
+                            enabled=device.type == 'cuda'):
+            # forward 
+            embeddings = model(features, graph)
+            
+            # Use negative sampling loss (simplified)
+            # Negative sample: a pool of random nodes shared by every positive
+            # source (not filtered against the adjacency)
+            torch.randint(0, num_nodes, (num_neg,), generator=g_dev,
+                          out=neg_pool)
+            
+            # Gather every target row at once: positive destinations, then
+            # the negative pool
+            pos_emb = embeddings[pos_src]
+            dst_emb = embeddings[target_idx]
+            
+            # Calculate the similarity of positive samples (batched dot)
+            pos_similarity = torch.einsum('nd,nd->n', pos_emb,
+                                          dst_emb[:num_pos])
+            
+            # Calculate negative sample similarity against the whole pool
+            neg_similarity = pos_emb @ dst_emb[num_pos:].t()
+            
+            # Loss function: Maximize positive sample similarity 
+            # and minimize negative sample similarity
+            logits = torch.cat([pos_similarity, neg_similarity.flatten()])
+            loss = F.binary_cross_entropy_with_logits(
+                logits, labels, weight=loss_weights, reduction='sum'
+            )
         
         loss.backward()
         optimizer.step()
         
-        losses.append(loss.item())
+        losses_t[epoch] = loss.detach()
         
         if (epoch + 1) % 10 == 0:
-            print(f'Epoch {epoch+1}/{num_epochs}, Loss: {loss.item():.4f}')
+            for logged_epoch, host_loss, done in pending:
+                if done is not None:
+                    done.synchronize()
+                print(f'Epoch {logged_epoch+1}/{num_epochs}, '
+                      f'Loss: {host_loss.item():.4f}')
+            pending.clear()
+            
+            host_loss = losses_t[epoch].to('cpu', non_blocking=True)
+            done = None
+            if device.type == 'cuda':
+                done = torch.cuda.Event()
+                done.record()
+            pending.append((epoch, host_loss, done))
+    
+    losses = losses_t.cpu().tolist()
+    for logged_epoch, _, _ in pending:
+        print(f'Epoch {logged_epoch+1}/{num_epochs}, '
+              f'Loss: {losses[logged_epoch]:.4f}')
     
     # Get final embedding
     model.eval()
-    with torch.no_grad():
-        final_embeddings = model(features, edge_index).cpu().numpy()
+    with torch.inference_mode():
+        final_embeddings = model(features, graph).cpu().numpy()
     
     # Generate bias (based on node features)
-    biases = np.random.randn(num_nodes) * 0.1
+    biases = rng.standard_normal(num_nodes) * 0.1
     
     print(f"Training completed, final loss: {losses[-1]:.4f}")
     
     # training loss function
-    plt.figure(figsize=(10, 6))
-    plt.plot(losses)
-    plt.xlabel('Epoch')
-    plt.ylabel('Loss')
-    plt.title('GraphSAGE Training Loss')
-    plt.grid(True, alpha=0.3)
-    plt.savefig('training_loss.png', dpi=150, bbox_inches='tight')
-    plt.close()
+    if plot:
+        import matplotlib
+        matplotlib.use('Agg')
+        import matplotlib.pyplot as plt
+        
+        plt.figure(figsize=(10, 6))
+        plt.plot(losses)
+        plt.xlabel('Epoch')
+        plt.ylabel('Loss')
+        plt.title('GraphSAGE Training Loss')
+        plt.grid(True, alpha=0.3)
+        plt.savefig('training_loss.png', dpi=150, bbox_inches='tight')
+        plt.close()
     
     return final_embeddings, biases, G
 
@@ -213,6 +295,9 @@ def save_embeddings(embeddings, biases, filename='emb_16.csv'):
 
 def visualize_embeddings(embeddings, G, filename='embedding_visualization.png'):
     """Visualization Embedding (2D PCA)"""
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
     from sklearn.decomposition import PCA
     
     # Use PCA to reduce dimensions to 2D
@@ -249,12 +334,17 @@ def visualize_embeddings(embeddings, G, filename='embedding_visualization.png'):
     print(f"  PCA explained variance ratio: {pca.explained_variance_ratio_.sum():.3f}")
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="GSQR GraphSAGE embedding training")
+    parser.add_argument('--plot', action='store_true',
+                        help="save the training loss and embedding plots")
+    args = parser.parse_args()
+    
     print("=" * 60)
     print("GSQR - GraphSAGE training embedding")
     print("=" * 60)
     
-    np.random.seed(42)
     torch.manual_seed(42)
+    rng = np.random.default_rng(42)
     
     # training parameters
     num_nodes = 30      
@@ -262,14 +352,16 @@ if __name__ == "__main__":
     
     try:
         # training embedding
-        embeddings, biases, G = train_embeddings(num_nodes, num_epochs)
+        embeddings, biases, G = train_embeddings(num_nodes, num_epochs, rng,
+                                                 plot=args.plot)
         
         if embeddings is not None:
             # Save embedded
             csv_file = save_embeddings(embeddings, biases)
             
             # Visualization embedding
-            visualize_embeddings(embeddings, G)
+            if args.plot:
+                visualize_embeddings(embeddings, G)
             
             print("\n✅ Training completed")
             print("next step:")